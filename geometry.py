@@ -1,6 +1,7 @@
 import helperclasses as hc
 import glm
 import igl
+import numpy as np
 
 class Geometry:
     def __init__(self, name: str, gtype: str, materials: list[hc.Material]):
@@ -11,6 +12,15 @@ class Geometry:
     def intersect(self, ray: hc.Ray, intersect: hc.Intersection):
         return intersect
 
+    def intersect_many(self, origins: np.ndarray, directions: np.ndarray):
+        # Vectorized intersection of N rays (origins is (N, 3), directions is (N, 3) or (3,))
+        # Only the distances t are returned, inf where a ray misses
+        return np.full(len(origins), float("inf"))
+
+    def bounds(self):
+        # Axis aligned bounds (minpos, maxpos) of the geometry, or None if it is unbounded
+        return None
+
 class Sphere(Geometry):
     def __init__(self, name: str, gtype: str, materials: list[hc.Material], center: glm.vec3, radius: float):
         super().__init__(name, gtype, materials)
@@ -75,6 +85,29 @@ class Sphere(Geometry):
         # Find the material of the object at that position
         return hc.Intersection(t1, n, position, self.materials[0])
 
+    def intersect_many(self, origins: np.ndarray, directions: np.ndarray):
+        p = origins - np.array(self.center, dtype=float)
+        d = np.broadcast_to(directions, origins.shape)
+
+        a = np.sum(d * d, axis=1)
+        b = 2 * np.sum(d * p, axis=1)
+        c = np.sum(p * p, axis=1) - self.radius * self.radius
+
+        discriminant = b*b - 4 * a * c
+        sqrtDiscriminant = np.sqrt(np.maximum(discriminant, 0))
+
+        t1 = (-b + sqrtDiscriminant) / (2*a)
+        t2 = (-b - sqrtDiscriminant) / (2*a)
+
+        # t2 <= t1, so take t2 if it is in front of the ray and t1 otherwise
+        t = np.where(t2 > 0, t2, np.where(t1 > 0, t1, float("inf")))
+        t[discriminant < 0] = float("inf")
+        return t
+
+    def bounds(self):
+        r = glm.vec3(self.radius)
+        return self.center - r, self.center + r
+
 
 class Plane(Geometry):
     def __init__(self, name: str, gtype: str, materials: list[hc.Material], point: glm.vec3, normal: glm.vec3):
@@ -140,6 +173,18 @@ class Plane(Geometry):
         else : 
             return hc.Intersection(t, n, position, self.materials[0])
 
+    def intersect_many(self, origins: np.ndarray, directions: np.ndarray):
+        n = np.array(self.normal, dtype=float)
+        d = np.broadcast_to(directions, origins.shape)
+        D = -np.dot(n, np.array(self.point, dtype=float))
+
+        denominator = d @ n
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t = -(origins @ n + D) / denominator
+
+        t[(denominator == 0) | ~(t >= 0)] = float("inf")
+        return t
+
 
 class AABB(Geometry):
     def __init__(self, name: str, gtype: str, materials: list[hc.Material], minpos: glm.vec3, maxpos: glm.vec3):
@@ -219,6 +264,23 @@ class AABB(Geometry):
 
         # returning all the values
         return hc.Intersection(tMin, n, position, self.materials[0])
+
+    def intersect_many(self, origins: np.ndarray, directions: np.ndarray):
+        d = np.broadcast_to(directions, origins.shape)
+
+        # Slab intersections for all three axis at once
+        with np.errstate(divide="ignore", invalid="ignore"):
+            tMin_axis = (np.array(self.minpos, dtype=float) - origins) / d
+            tMax_axis = (np.array(self.maxpos, dtype=float) - origins) / d
+
+        tMin = np.max(np.minimum(tMin_axis, tMax_axis), axis=1)
+        tMax = np.min(np.maximum(tMin_axis, tMax_axis), axis=1)
+
+        # Same rules as intersect : no hit if the slabs don't overlap or if the box starts behind the ray
+        return np.where((tMin <= tMax) & (tMin >= 0), tMin, float("inf"))
+
+    def bounds(self):
+        return self.minpos, self.maxpos
  
 
 class Mesh(Geometry):
@@ -237,6 +299,16 @@ class Mesh(Geometry):
         pass
         # TODO: Create intersect code for Mesh
 
+    def bounds(self):
+        if len(self.verts) == 0:
+            return None
+        minpos = glm.vec3(self.verts[0])
+        maxpos = glm.vec3(self.verts[0])
+        for v in self.verts:
+            minpos = glm.min(minpos, v)
+            maxpos = glm.max(maxpos, v)
+        return minpos, maxpos
+
 class Node(Geometry):
     def __init__(self, name: str, gtype: str, M: glm.mat4, materials: list[hc.Material]):
         super().__init__(name, gtype, materials)        
@@ -301,7 +373,38 @@ class Node(Geometry):
 
         return hc.Intersection(closestIntersection.t, n, position, closestIntersection.mat)
 
-
-
-
-
+    def intersect_many(self, origins: np.ndarray, directions: np.ndarray):
+        d = np.broadcast_to(directions, origins.shape)
+
+        # Transform all the rays into the object's coordinates, t stays the same since d is not normalized
+        Minv = np.array(self.Minv, dtype=float)
+        p1 = origins @ Minv[:3, :3].T + Minv[:3, 3]
+        d1 = d @ Minv[:3, :3].T
+
+        t = np.full(len(origins), float("inf"))
+        for child in self.children :
+            t = np.minimum(t, child.intersect_many(p1, d1))
+        return t
+
+    def bounds(self):
+        if len(self.children) == 0 :
+            return None
+
+        minpos = glm.vec3(float("inf"))
+        maxpos = glm.vec3(float("-inf"))
+
+        for child in self.children :
+            childBounds = child.bounds()
+            if childBounds == None :
+                return None
+
+            # Transform the 8 corners of the child's box to get the node's box
+            cMin, cMax = childBounds
+            for x in (cMin.x, cMax.x) :
+                for y in (cMin.y, cMax.y) :
+                    for z in (cMin.z, cMax.z) :
+                        corner = glm.vec3(self.M * glm.vec4(x, y, z, 1.0))
+                        minpos = glm.min(minpos, corner)
+                        maxpos = glm.max(maxpos, corner)
+
+        return minpos, maxpos
@@ -3,8 +3,19 @@ import glm
 import numpy as np
 import geometry as geom
 import helperclasses as hc
+import shadowmap as sm
 from tqdm import tqdm
 
+def box_corners(bounds):
+    # The 8 corners of axis aligned bounds (minpos, maxpos)
+    bMin, bMax = bounds
+    corners = []
+    for x in (bMin.x, bMax.x) :
+        for y in (bMin.y, bMax.y) :
+            for z in (bMin.z, bMax.z) :
+                corners.append((x, y, z))
+    return corners
+
 class Scene:
 
     def __init__(self,
@@ -18,7 +29,12 @@ class Scene:
                  fov: float,
                  ambient: glm.vec3,
                  lights: list[hc.Light],
-                 objects: list[geom.Geometry]
+                 objects: list[geom.Geometry],
+                 shadow_mode: str = "ray",
+                 shadow_map_resolution: int = None,
+                 shadow_bias: float = 0.01,
+                 shadow_pcf: int = 0,
+                 tile_size: int = 16
                  ):
         self.width = width  # width of image
         self.height = height  # height of image
@@ -32,6 +48,159 @@ class Scene:
         self.ambient = ambient  # ambient lighting
         self.lights = lights  # all lights in the scene
         self.objects = objects  # all objects in the scene
+        self.shadow_mode = shadow_mode  # "ray" for exact shadow rays, "map" for shadow maps on directional lights
+        self.shadow_map_resolution = shadow_map_resolution  # texels along each side of a shadow map, None to match the image size
+        self.shadow_bias = shadow_bias  # depth bias used for shadow map lookups
+        self.shadow_pcf = shadow_pcf  # percentage-closer filtering radius in texels (0 = no filtering)
+        self.tile_size = tile_size  # size in pixels of the screen tiles used to bin objects for primary rays
+
+    def screen_rect(self, objBounds, u: glm.vec3, v: glm.vec3, w: glm.vec3,
+                    left: float, right: float, bottom: float, top: float, distance_to_plane: float):
+        # Pixel rectangle (colMin, colMax, rowMin, rowMax) covered by the projection of an object's bounds
+        # Returns None if the bounds are outside of the view frustum
+        colMin, colMax = 0, self.width - 1
+        rowMin, rowMax = 0, self.height - 1
+
+        # Unbounded objects (planes) can show up anywhere on the screen
+        if objBounds == None :
+            return colMin, colMax, rowMin, rowMax
+
+        bMin, bMax = objBounds
+        corners = []
+        for x in (bMin.x, bMax.x) :
+            for y in (bMin.y, bMax.y) :
+                for z in (bMin.z, bMax.z) :
+                    corner = glm.vec3(x, y, z) - self.eye_position
+                    # camera coordinates, depth is positive in front of the camera
+                    corners.append((glm.dot(corner, u), glm.dot(corner, v), -glm.dot(corner, w)))
+
+        if all(depth <= 0 for _, _, depth in corners) :
+            return None  # the whole object is behind the camera
+
+        # Only project the bounds if they are fully in front of the camera, otherwise keep the whole screen
+        if all(depth > 1e-6 for _, _, depth in corners) :
+            # Same mapping as the primary rays : s = e + x * u - y * v - distance_to_plane * w
+            screenX = [distance_to_plane * xc / depth for xc, _, depth in corners]
+            screenY = [-distance_to_plane * yc / depth for _, yc, depth in corners]
+
+            colMin = max(colMin, math.floor((min(screenX) - left) / (right - left) * self.width))
+            colMax = min(colMax, math.floor((max(screenX) - left) / (right - left) * self.width))
+            rowMin = max(rowMin, math.floor((min(screenY) - bottom) / (top - bottom) * self.height))
+            rowMax = min(rowMax, math.floor((max(screenY) - bottom) / (top - bottom) * self.height))
+
+            if colMin > colMax or rowMin > rowMax :
+                return None  # the object is outside of the view frustum
+
+        return colMin, colMax, rowMin, rowMax
+
+    def bin_objects(self, u: glm.vec3, v: glm.vec3, w: glm.vec3,
+                    left: float, right: float, bottom: float, top: float, distance_to_plane: float):
+        # Drops the objects outside of the view frustum and bins the others into the screen tiles they overlap
+        # Returns a list of candidate objects for every tile, indexed [tile row][tile col]
+        tileRows = (self.height + self.tile_size - 1) // self.tile_size
+        tileCols = (self.width + self.tile_size - 1) // self.tile_size
+        bins = [[[] for _ in range(tileCols)] for _ in range(tileRows)]
+
+        for sceneObject in self.objects :
+            rect = self.screen_rect(sceneObject.bounds(), u, v, w, left, right, bottom, top, distance_to_plane)
+            if rect == None :
+                continue
+
+            colMin, colMax, rowMin, rowMax = rect
+            for tileRow in range(rowMin // self.tile_size, rowMax // self.tile_size + 1) :
+                for tileCol in range(colMin // self.tile_size, colMax // self.tile_size + 1) :
+                    bins[tileRow][tileCol].append(sceneObject)
+
+        return bins
+
+    def visible_receivers(self, light: hc.Light, casters: list[geom.Geometry], u: glm.vec3, v: glm.vec3, w: glm.vec3,
+                          left: float, right: float, bottom: float, top: float, distance_to_plane: float):
+        # World space points spanning every surface the camera can see that a directional light can shadow,
+        # as an (N, 3) array. Shadow maps only need to cover these points seen from the light
+        points = []
+
+        # Rays through the 4 corners of the image
+        e = np.array(self.eye_position, dtype=float)
+        cornerDirections = []
+        for x in (left, right) :
+            for y in (bottom, top) :
+                cornerDirections.append(np.array(x * u - y * v - distance_to_plane * w, dtype=float))
+        cornerDirections = np.array(cornerDirections)
+
+        toLight = np.array(light.vector, dtype=float)
+
+        for sceneObject in self.objects :
+            objBounds = sceneObject.bounds()
+
+            if objBounds != None :
+                if self.screen_rect(objBounds, u, v, w, left, right, bottom, top, distance_to_plane) != None :
+                    points.extend(box_corners(objBounds))
+                continue
+
+            # The visible part of a plane is bounded by where the corner rays hit it, if they all do
+            t = sceneObject.intersect_many(np.broadcast_to(e, cornerDirections.shape), cornerDirections)
+            if np.all(t < float("inf")) :
+                points.extend(e + t[:, None] * cornerDirections)
+                continue
+            if not np.any(t < float("inf")) :
+                continue  # the plane is not visible
+
+            # Otherwise the plane goes up to the horizon. Seen from the light a shadow covers the same area
+            # as its caster, so every caster whose shadow on the plane is on screen is added instead
+            for caster in casters :
+                casterBounds = caster.bounds()
+                if casterBounds == None :
+                    continue
+
+                corners = np.array(box_corners(casterBounds), dtype=float)
+                tShadow = sceneObject.intersect_many(corners, -toLight)
+                shadow = np.vstack((corners, corners[tShadow < float("inf")] - tShadow[tShadow < float("inf"), None] * toLight))
+                shadowBounds = (glm.vec3(*shadow.min(axis=0)), glm.vec3(*shadow.max(axis=0)))
+
+                if self.screen_rect(shadowBounds, u, v, w, left, right, bottom, top, distance_to_plane) != None :
+                    points.extend(corners)
+
+        return np.array(points, dtype=float).reshape(-1, 3)
+
+    def primary_ray(self, col: int, row: int, sub_col: int, sub_row: int, u: glm.vec3, v: glm.vec3, w: glm.vec3,
+                    left: float, right: float, bottom: float, top: float, distance_to_plane: float):
+        # Ray from the eye through the center of subpixel (sub_col, sub_row) of pixel (col, row)
+        e = self.eye_position
+
+        subpixel_x = left + (col + (sub_col + 0.5) / self.samples) * (right - left) / self.width
+        subpixel_y = bottom + (row + (sub_row + 0.5) / self.samples) * (top - bottom) / self.height
+
+        # Calculating the position in 3D of the pixel (in camera coordinates)
+        s = e + subpixel_x * u + -subpixel_y * v - distance_to_plane * w
+        d = glm.normalize(s - e)    # goes from the eye to the pixel
+        return hc.Ray(e, d)
+
+    def trace_shadow_queue(self, light: hc.Light, positions: np.ndarray, normals: np.ndarray):
+        # Traces the shadow rays of all the (N, 3) hit positions towards one light as a single queue
+        # Returns 1 for the positions that see the light and 0 for the ones in shadow
+        origins = positions + 0.01 * normals    # adding a bit of offset
+
+        if light.type == "directional" :
+            # light.vector is already the normalized direction towards the light
+            directions = np.broadcast_to(np.array(light.vector, dtype=float), positions.shape)
+        else :
+            directions = np.array(light.vector, dtype=float) - positions
+            directions = directions / np.linalg.norm(directions, axis=1, keepdims=True)
+
+        # Sorting the queue by direction octant, then by origin, so neighbouring rays are coherent
+        octants = (directions[:, 0] < 0) * 4 + (directions[:, 1] < 0) * 2 + (directions[:, 2] < 0)
+        order = np.lexsort((origins[:, 2], origins[:, 1], origins[:, 0], octants))
+        origins = origins[order]
+        directions = directions[order]
+
+        inShadow = np.zeros(len(origins), dtype=bool)
+        for obj in self.objects:
+            if (obj.name != 'plane') : 
+                inShadow |= obj.intersect_many(origins, directions) < float("inf")
+
+        visibility = np.empty(len(origins))
+        visibility[order] = np.where(inShadow, 0.0, 1.0)
+        return visibility
 
     def render(self):
 
@@ -49,160 +218,132 @@ class Scene:
         u = glm.normalize(u)
         vUnitVector = glm.cross(w, u)
 
-        for col in tqdm(range(self.width)):
-            for row in range(self.height):
+        # Shadow maps replace the shadow rays of directional lights
+        shadowMaps = {}
+        if self.shadow_mode == "map" :
+            casters = [obj for obj in self.objects if obj.name != 'plane']
+
+            # The depth pass costs about as much as tracing one shadow ray per texel,
+            # so by default the map gets as many texels per side as the image has pixels
+            resolution = self.shadow_map_resolution
+            if resolution == None :
+                resolution = max(self.width, self.height)
+
+            for light in self.lights :
+                if light.type == "directional" :
+                    receivers = self.visible_receivers(light, casters, u, vUnitVector, w,
+                                                       left, right, bottom, top, distance_to_plane)
+                    shadowMaps[light] = sm.ShadowMap(light, casters, receivers,
+                                                     resolution, self.shadow_bias, self.shadow_pcf)
+
+        # Primary rays only test the objects binned to their tile
+        tileBins = self.bin_objects(u, vUnitVector, w, left, right, bottom, top, distance_to_plane)
+
+        # Wavefront rendering, one tile at a time :
+        #   1. trace all the primary rays of the tile and keep their closest hits
+        #   2. trace the shadow rays of every light as one sorted queue per light
+        #   3. shade the hits with the visibilities found for each light
+        for tileRow in tqdm(range(len(tileBins))):
+            for tileCol in range(len(tileBins[tileRow])):
+
+                candidates = tileBins[tileRow][tileCol]
+                rowStart = tileRow * self.tile_size
+                colStart = tileCol * self.tile_size
+
+                # Stage 1 : primary hits
+                hits = []  # (row, col, ray, intersection) of every subpixel ray that hit something
+
+                for col in range(colStart, min(colStart + self.tile_size, self.width)):
+                    for row in range(rowStart, min(rowStart + self.tile_size, self.height)):
+                        for sub_col in range(self.samples):
+                            for sub_row in range(self.samples):
+                                r = self.primary_ray(col, row, sub_col, sub_row, u, vUnitVector, w,
+                                                     left, right, bottom, top, distance_to_plane)
+
+                                intersection = hc.Intersection(float("inf"), None, None, None)
+                                closest_t = float("inf")
+
+                                for sceneObject in candidates :
+                                    curIntersection = sceneObject.intersect(r, hc.Intersection(float("inf"), None, None, None))
+                                    if curIntersection.t < closest_t :
+                                        closest_t = curIntersection.t
+                                        intersection = curIntersection
+
+                                if intersection.position != None :  # if there's an intersection found
+                                    hits.append((row, col, r, intersection))
+
+                if len(hits) == 0 :
+                    continue  # every subpixel of the tile is black
+
+                # Stage 2 : visibility of every light from every hit
+                positions = np.array([intersection.position for _, _, _, intersection in hits], dtype=float)
+                normals = np.array([intersection.normal for _, _, _, intersection in hits], dtype=float)
+
+                visibilities = {}
+                for light in self.lights :
+                    if light in shadowMaps :
+                        # Looking up the shadow map instead of tracing shadow rays
+                        visibilities[light] = shadowMaps[light].visibility(positions, normals)
+                    else :
+                        visibilities[light] = self.trace_shadow_queue(light, positions, normals)
+
+                # Stage 3 : shading
+                for k, (row, col, r, intersection) in enumerate(hits) :
+                    n = intersection.normal
+                    curPixel = intersection.position
+                    material = intersection.mat
+
+                    v = - glm.normalize(r.direction)    # from the current pixel towards the camera
+
+                    ambientLight = self.ambient * material.diffuse
+                    diffuseLight = glm.vec3(0, 0, 0)
+                    blinnPhongLight = glm.vec3(0, 0, 0)
+
+                    for light in self.lights : 
+                        visibility = float(visibilities[light][k])
+                        if visibility == 0 :
+                            continue
+
+                        lightPosition = light.vector
+
+                        if light.type == "point" :  # Attenuate the light intensity if it's a point light
+                            distance = np.linalg.norm(lightPosition - curPixel) 
+                            k_c = light.attenuation[2]
+                            k_l = light.attenuation[1]
+                            k_q = light.attenuation[0]
+
+                            attenuationFactor = 1 / (k_c + k_l * distance + k_q * distance * distance)
+
+                            I = attenuationFactor * light.colour 
+                            I[0] = max(0.0, min(1.0, I[0]))
+                            I[1] = max(0.0, min(1.0, I[1]))
+                            I[2] = max(0.0, min(1.0, I[2]))
+
+                        else : 
+                            I = light.colour # --> a vector with RGB components
+
+                        # light ray from pixel to light source
+                        if light.type == "directional" :
+                            l = light.vector
+                        else : 
+                            l = glm.normalize(lightPosition - curPixel)
 
-                # TODO: Generate rays
-                e = self.eye_position
+                        # Calculating the Lambertian diffuse shading
+                        k_d = material.diffuse
+                        diffuseLight = diffuseLight + visibility * k_d * I * max(0, glm.dot(n, l))
 
-                # Calculating the position in 2D of the pixel 
-                # pixelX_Bound = (col/self.width) * (right - left) + left
-                # pixelY_Bound = (row/self.height) * (top - bottom) + left
+                        # Calculating the Blinn-Phong specular shading
+                        p_exponent = material.shininess 
+                        k_s = material.specular
+                        h = (v + l) / np.linalg.norm(v + l)     # this is the bissector between v and l
 
-                pixelX = ((col + 0.5)/self.width) * (right - left) + left
-                pixelY = ((row + 0.5)/self.height) * (top - bottom) + bottom
+                        blinnPhongLight = blinnPhongLight + visibility * k_s * I * math.pow(max(0, glm.dot(n, h)), p_exponent)
 
-                subPixel_sizeX = (right - left) / (self.width * self.samples)
-                subPixel_sizeY = (top - bottom) / (self.height * self.samples)
-
-                pixelColor = glm.vec3(0, 0, 0)
-
-                for sub_col in range(self.samples):
-                    for sub_row in range(self.samples):
-                        subpixel_x = left + (col + (sub_col + 0.5) / self.samples) * (right - left) / self.width
-                        subpixel_y = bottom + (row + (sub_row + 0.5) / self.samples) * (top - bottom) / self.height
-
-                        # if self.jitter:
-                        #     subpixel_x += (0.01) * subPixel_sizeX
-                        #     subpixel_y += (0.01) * subPixel_sizeY
-
-                        # Calculating the position in 3D of the pixel (in camera coordinates)
-                        s = e + subpixel_x * u + -subpixel_y * vUnitVector - distance_to_plane * w
-                        p = e
-                        d = s - e   # goes from the eye to the pixel
-                        d = glm.normalize(d)    # normalizing the direction vector
-                        r = hc.Ray(p, d)
-
-                        # TODO: Test for intersection with all objects
-
-                        intersection = hc.Intersection(float("inf"), None, None, None)
-                        closest_t = float("inf")
-                        objectRendered = None
-
-                        for sceneObject in self.objects : 
-                            # print(obj.name)
-                            curIntersection = sceneObject.intersect(r, hc.Intersection(float("inf"), None, None, None))
-                            # print("curIntersection.t : ", curIntersection.t)
-                            # print("curIntersection.n : ", curIntersection.normal)
-                            
-                            if curIntersection.t < closest_t :
-                                closest_t = curIntersection.t
-                                # print("closest_t : ", closest_t)
-                                intersection = curIntersection
-                                objectRendered = sceneObject
-                                # print(obj.name, "was chosen to be rendered!") 
-
-                            # Comment this??
-                        if intersection.position != None :  # if there's an intersection found
-
-                            print("intersection found!")
-
-                            # TODO: Perform shading computations on the closest intersection point
-                            n = intersection.normal
-                            curPixel = intersection.position
-                            material = intersection.mat
-
-                            v = self.eye_position - curPixel    # from the current pixel towards the camera
-                            v = glm.normalize(v)
-
-                            ambientLight = glm.vec3(0, 0, 0)
-                            diffuseLight = glm.vec3(0, 0, 0)
-                            blinnPhongLight = glm.vec3(0, 0, 0)
-
-                            subpixelColour = glm.vec3(1, 1, 1)  # color = white IF there are intersections found
-
-                            for light in self.lights : 
-                                # print("\nlight.name: ", light.name)
-
-                                lightPosition = light.vector
-
-                                if light.type == "point" :  # Attenuate the light intensity if it's a point light
-                                    distance = np.linalg.norm(lightPosition - curPixel) 
-                                    k_c = light.attenuation[2]
-                                    k_l = light.attenuation[1]
-                                    k_q = light.attenuation[0]
-
-                                    attenuationFactor = 1 / (k_c + k_l * distance + k_q * distance * distance)
-
-                                    I = attenuationFactor * light.colour 
-                                    I[0] = max(0.0, min(1.0, I[0]))
-                                    I[1] = max(0.0, min(1.0, I[1]))
-                                    I[2] = max(0.0, min(1.0, I[2]))
-
-                                else : 
-                                    I = light.colour # --> a vector with RGB components
-
-                                l = lightPosition - curPixel    # light ray from pixel to light source
-                                l = glm.normalize(l)
-                                # print("l : ", l)
-
-                                # Doing the shadow rays : 
-
-                                dirToLight = glm.normalize(lightPosition - curPixel)
-                                shadowRay = hc.Ray(curPixel + 0.01 * n , dirToLight)    # adding a bit of offset
-                                inShadow = False
-
-                                for obj in self.objects:
-                                    if (obj.name != 'plane') : 
-                                        shadowIntersect = obj.intersect(shadowRay, hc.Intersection(float("inf"), None, None, None))
-                                        # print("objectRendered :", objectRendered.name)
-                                        # print("obj :", obj.name)
-                                        if (shadowIntersect.position != None) :   
-                                            # print(objectRendered.name, "collided with ", obj.name, "when reaching", light.name)
-                                            # print("inShadow!")
-                                            # If an interception is found AND we're not intercepting our own object
-                                            inShadow = True
-                                
-                                if not inShadow :
-                                    v = - glm.normalize(r.direction)
-                                    l = glm.normalize(lightPosition - curPixel)
-                                    
-                                # Calculating the Lambertian diffuse shading
-                                    k_d = material.diffuse
-                                    diffuseLight = diffuseLight + k_d * I * max(0, glm.dot(n, l))
-
-                                    # Calculating the Blinn-Phong specular shading
-                                    p_exponent = material.shininess 
-                                    k_s = material.specular
-                                    h = (v + l) / np.linalg.norm(v + l)     # this is the bissector between v and l
-
-                                    blinnPhongLight = blinnPhongLight + k_s * I * math.pow(max(0, glm.dot(n, h)), p_exponent)
-
-                            ambientLight = ambientLight + self.ambient * material.diffuse
-                            subpixelColour = ambientLight + diffuseLight + blinnPhongLight
-                            
-                            # print(objectRendered.name)
-                            # print("Final colour : ", colour)
-                            # print()
+                    subpixelColour = ambientLight + diffuseLight + blinnPhongLight
+                    image[row, col] += (subpixelColour.x, subpixelColour.y, subpixelColour.z)
 
-                        else : 
-                            subpixelColour = glm.vec3(0, 0, 0)  # color = black 
-                        
-                        pixelColor = pixelColor + subpixelColour
-                        print("current Pixel Color : ", pixelColor)
-
-                pixelColor = pixelColor / (self.samples * self.samples)
-                print("FINAL Pixel Color : ", pixelColor)
-                    
-                image[row, col, 0] = max(0.0, min(1.0, pixelColor.x))
-                image[row, col, 1] = max(0.0, min(1.0, pixelColor.y))
-                image[row, col, 2] = max(0.0, min(1.0, pixelColor.z))
-                    
-                # if objectRendered != None : 
-                #     print(objectRendered.name)
-                #     print(image[row, col, 0])
-                #     print(image[row, col, 1])
-                #     print(image[row, col, 2])
-                #     print()
+        # Averaging the subpixels (misses are black) and clamping the colours
+        image = image / (self.samples * self.samples)
+        image = np.clip(image, 0.0, 1.0)
 
         return image
@@ -38,6 +38,30 @@ def load_scene(infile: str):
     # Loading Anti-Aliasing options    
     jitter = data.get( "AA_jitter", False ) # default to no jitter
     samples = data.get( "AA_samples", 1 ) # default to no supersampling
+
+    # Loading shadow options
+    shadow_mode = data.get( "shadow_mode", "ray" ) # default to exact shadow rays
+    if shadow_mode not in ("ray", "map"):
+        print("Unkown shadow mode", shadow_mode, ", using shadow rays")
+        shadow_mode = "ray"
+    shadow_map_resolution = data.get( "shadow_map_resolution", None ) # default to the image size
+    if shadow_map_resolution != None and (not isinstance(shadow_map_resolution, int) or shadow_map_resolution < 1):
+        print("Invalid shadow map resolution", shadow_map_resolution, ", using the image size")
+        shadow_map_resolution = None
+    shadow_bias = data.get( "shadow_bias", 0.01 )
+    if not isinstance(shadow_bias, (int, float)) or shadow_bias < 0:
+        print("Invalid shadow bias", shadow_bias, ", using 0.01")
+        shadow_bias = 0.01
+    shadow_pcf = data.get( "shadow_pcf", 0 ) # default to a single depth lookup
+    if not isinstance(shadow_pcf, int) or shadow_pcf < 0:
+        print("Invalid shadow PCF radius", shadow_pcf, ", using 0")
+        shadow_pcf = 0
+
+    # Loading the screen tile size used to bin objects for primary rays
+    tile_size = data.get( "tile_size", 16 )
+    if not isinstance(tile_size, int) or tile_size < 1:
+        print("Invalid tile size", tile_size, ", using 16")
+        tile_size = 16
     
     # Loading scene lights
     lights = []    
@@ -80,7 +104,9 @@ def load_scene(infile: str):
     return scene.Scene(width, height, jitter, samples,  # General settings
                 cam_pos, cam_lookat, cam_up, cam_fov,  # Camera settings
                 ambient, lights,  # Light settings
-                objects)  # Geometries to render
+                objects,  # Geometries to render
+                shadow_mode, shadow_map_resolution, shadow_bias, shadow_pcf,  # Shadow settings
+                tile_size)  # Primary ray binning
 
 def load_geometry( geometry, material_by_name, geometry_by_name ):
 
@@ -0,0 +1,99 @@
+import glm
+import numpy as np
+import geometry as geom
+import helperclasses as hc
+
+class ShadowMap:
+    def __init__(self, light: hc.Light, casters: list[geom.Geometry], receivers: np.ndarray,
+                 resolution: int, bias: float, pcf: int):
+        self.resolution = resolution  # number of texels along each side of the map
+        self.bias = bias  # depth bias to avoid surfaces shadowing themselves
+        self.pcf = pcf  # radius (in texels) of the percentage-closer filtering kernel, 0 for a single lookup
+
+        # Light space basis, w points towards the light
+        w = glm.normalize(light.vector)
+        hint = glm.vec3(0, 1, 0) if abs(w.y) < 0.999 else glm.vec3(1, 0, 0)
+        u = glm.normalize(glm.cross(hint, w))
+        v = glm.cross(w, u)
+        self.u = np.array(u, dtype=float)
+        self.v = np.array(v, dtype=float)
+        self.w = np.array(w, dtype=float)
+
+        # Fit the map around the corners of all the bounded casters, clipped to the visible receivers
+        # (an (N, 3) array of points) since only shadows landing on those can show up in the image
+        corners = []
+        for obj in casters :
+            objBounds = obj.bounds()
+            if objBounds == None :
+                continue
+            bMin, bMax = objBounds
+            for x in (bMin.x, bMax.x) :
+                for y in (bMin.y, bMax.y) :
+                    for z in (bMin.z, bMax.z) :
+                        corners.append((x, y, z))
+
+        self.depth = None
+        if len(corners) == 0 or len(receivers) == 0 :
+            return  # nothing can cast a visible shadow, every lookup is lit
+
+        corners = np.array(corners, dtype=float)
+        self.uMin = max((corners @ self.u).min(), (receivers @ self.u).min())
+        self.vMin = max((corners @ self.v).min(), (receivers @ self.v).min())
+        uMax = min((corners @ self.u).max(), (receivers @ self.u).max())
+        vMax = min((corners @ self.v).max(), (receivers @ self.v).max())
+        if self.uMin > uMax or self.vMin > vMax :
+            return  # the casters' shadows all fall outside of the visible receivers
+
+        self.texelU = max(uMax - self.uMin, 1e-6) / resolution
+        self.texelV = max(vMax - self.vMin, 1e-6) / resolution
+        self.near = (corners @ self.w).max() + 1.0  # distance along w of the plane the depth rays start from
+
+        # Depth pass : one ray per texel center, all going away from the light
+        su = self.uMin + (np.arange(resolution) + 0.5) * self.texelU
+        sv = self.vMin + (np.arange(resolution) + 0.5) * self.texelV
+        gridV, gridU = np.meshgrid(sv, su, indexing="ij")
+        origins = gridU.reshape(-1, 1) * self.u + gridV.reshape(-1, 1) * self.v + self.near * self.w
+
+        depth = np.full(len(origins), float("inf"))
+        for obj in casters :
+            depth = np.minimum(depth, obj.intersect_many(origins, -self.w))
+        self.depth = depth.reshape(resolution, resolution)  # indexed [v, u]
+
+    def visibility(self, points: np.ndarray, normals: np.ndarray):
+        # Fraction of the light reaching each of the (N, 3) points with (N, 3) unit normals,
+        # between 0 (in shadow) and 1 (lit)
+        if self.depth is None :
+            return np.ones(len(points))
+
+        # The filter looks at texels up to pcf + 1 texels away, their depth can't be trusted closer than that
+        texel = (self.pcf + 1) * max(self.texelU, self.texelV)
+        cosTheta = np.clip(normals @ self.w, -1.0, 1.0)
+        sinTheta = np.sqrt(1.0 - cosTheta * cosTheta)
+
+        # Surfaces facing away from the light are in their own shadow, they get neither offset nor slope bias
+        facing = cosTheta > 0
+
+        # Normal offset : look the point up slightly off its surface, more so when the light grazes it
+        points = points + (texel * np.where(facing, sinTheta, 0.0))[:, None] * normals
+
+        # Slope-scaled bias : the depth of a tilted surface changes by tan(theta) per unit across a texel
+        slope = np.where(facing, sinTheta / np.maximum(cosTheta, 1e-3), 0.0)
+        bias = self.bias + texel * np.minimum(slope, 10.0)  # capped at grazing angles
+
+        i = np.floor((points @ self.u - self.uMin) / self.texelU).astype(int)
+        j = np.floor((points @ self.v - self.vMin) / self.texelV).astype(int)
+        pointDepth = self.near - points @ self.w
+
+        lit = np.zeros(len(points))
+        for dj in range(-self.pcf, self.pcf + 1) :
+            for di in range(-self.pcf, self.pcf + 1) :
+                ii = i + di
+                jj = j + dj
+                inside = (ii >= 0) & (ii < self.resolution) & (jj >= 0) & (jj < self.resolution)
+
+                # Texels outside of the map have no caster in front of them
+                texelDepth = np.full(len(points), float("inf"))
+                texelDepth[inside] = self.depth[jj[inside], ii[inside]]
+                lit += pointDepth - bias <= texelDepth
+
+        return lit / ((2 * self.pcf + 1) ** 2)